@@ -1,19 +1,25 @@
-from flask import Flask, render_template, jsonify, request
-from src.helper import download_hugging_face_embeddings
+from quart import Quart, Response, render_template, jsonify, request
+from src.helper import download_hugging_face_embeddings, QueryCache, normalize_query, MongoBulkWriter, stable_sort_documents, \
+    short_circuit, parse_answer, build_final_output, sse_event
 from langchain_pinecone import PineconeVectorStore
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 from dotenv import load_dotenv
 from src.prompt import *
-from pymongo import MongoClient
+from pymongo import MongoClient, DESCENDING
+from pymongo.write_concern import WriteConcern
+from concurrent.futures import ThreadPoolExecutor
 import os
+import atexit
+import asyncio
 import json
 from datetime import datetime
 
-# ------------------- Flask App -------------------
-app = Flask(__name__)
+# ------------------- Quart App -------------------
+app = Quart(__name__)
 
 # ------------------- Load Environment Variables -------------------
 load_dotenv()
@@ -25,10 +31,22 @@ os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
 os.environ["GROQ_API_KEY"] = GROQ_API_KEY
 
 # ------------------- MongoDB Setup -------------------
+chat_writer = None
 try:
-    mongo_client = MongoClient(MONGO_URI)
+    mongo_client = MongoClient(MONGO_URI, maxPoolSize=50, minPoolSize=5, serverSelectionTimeoutMS=2000)
     db = mongo_client["chatbot_dbbbb"]
     chat_collection = db["chat_history"]
+    # Chat saves are non-critical: fire-and-forget (w=0) handle for writes, acknowledged one for reads
+    chat_collection_fast = db.get_collection("chat_history", write_concern=WriteConcern(w=0))
+    chat_writer = MongoBulkWriter(chat_collection_fast, batch_size=100, flush_interval=1.0)
+    atexit.register(chat_writer.flush)
+except Exception as e:
+    print("❌ MongoDB setup error:", e)
+
+# MongoClient connects lazily, so this is the first real round-trip. If Mongo is down at boot
+# the writer above still exists and resumes saving once the server is reachable.
+try:
+    chat_collection.create_index([("timestamp", DESCENDING)], background=True)
     print("✅ Connected to MongoDB successfully!")
 except Exception as e:
     print("❌ MongoDB connection error:", e)
@@ -59,71 +77,175 @@ prompt = ChatPromptTemplate.from_messages(
 
 # ------------------- Retrieval Chain -------------------
 question_answer_chain = create_stuff_documents_chain(llm, prompt)
-rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+# Retrieved docs are put in a stable order so identical contexts hit the LLM's prefix cache
+sorted_retriever = RunnableLambda(lambda x: x["input"]) | retriever | RunnableLambda(stable_sort_documents)
+rag_chain = create_retrieval_chain(sorted_retriever, question_answer_chain)
+
+# ------------------- Warm-up -------------------
+# Pay model load / TLS handshake / lazy-init costs before the first real request
+if os.getenv("WARMUP", "1") == "1":
+    try:
+        rag_chain.invoke({"input": "warmup"})
+        print("🔥 RAG chain warmed up")
+    except Exception as e:
+        print("⚠️ Warm-up failed:", e)
+
+# ------------------- Response Cache -------------------
+query_cache = QueryCache(max_size=2000, ttl=600)
+
+# ------------------- Inference Worker -------------------
+# A single worker owns the RAG pipeline; request handlers only do light I/O
+# and hand queries over through an asyncio queue.
+MAX_BATCH_SIZE = 8
+inference_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def stream_answer(msg, response_q, loop):
+    """Run rag_chain.stream on the worker thread, forwarding answer chunks to the handler's queue"""
+    try:
+        for chunk in rag_chain.stream({"input": msg}):
+            if chunk.get("answer"):
+                loop.call_soon_threadsafe(response_q.put_nowait, chunk["answer"])
+    except Exception as e:
+        loop.call_soon_threadsafe(response_q.put_nowait, e)
+    loop.call_soon_threadsafe(response_q.put_nowait, None)  # end of stream
+
+
+async def server_loop(model_queue):
+    """Pull queued queries, coalescing up to MAX_BATCH_SIZE into one rag_chain.batch call"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await model_queue.get()]
+        while len(batch) < MAX_BATCH_SIZE and not model_queue.empty():
+            batch.append(model_queue.get_nowait())
+
+        blocking = [(msg, response_q) for msg, response_q, stream in batch if not stream]
+        streaming = [(msg, response_q) for msg, response_q, stream in batch if stream]
+
+        if blocking:
+            inputs = [{"input": msg} for msg, _ in blocking]
+            try:
+                results = await loop.run_in_executor(
+                    inference_executor,
+                    lambda: rag_chain.batch(inputs, return_exceptions=True)
+                )
+            except Exception as e:
+                results = [e] * len(blocking)
+
+            for (_, response_q), result in zip(blocking, results):
+                await response_q.put(result)
+
+        for msg, response_q in streaming:
+            await loop.run_in_executor(inference_executor, stream_answer, msg, response_q, loop)
+
+
+@app.before_serving
+async def startup_event():
+    app.model_queue = asyncio.Queue()
+    app.worker_task = asyncio.create_task(server_loop(app.model_queue))
+
 
 # ------------------- Routes -------------------
 @app.route("/")
-def index():
-    return render_template("chat.html")
+async def index():
+    return await render_template("chat.html")
 
 
 @app.route("/get", methods=["POST"])
-def chat():
-    msg = request.form.get("msg")
+async def chat():
+    form = await request.form
+    msg = form.get("msg")
     if not msg:
         return jsonify({"error": "No message provided"}), 400
 
     print(f"🧠 User Input: {msg}")
 
-    # Invoke RAG model
-    response = rag_chain.invoke({"input": msg})
-    raw_answer = response.get("answer", "")
+    # Trivial messages and repeated queries skip the pipeline
+    cache_key = normalize_query(msg)
+    cached = short_circuit(msg, cache_key, query_cache, chat_writer)
+    if cached is not None:
+        return jsonify(cached)
 
-    # ------------------- Parse JSON output -------------------
-    if "{" in raw_answer:
-        parts = raw_answer.split("{", 1)
-        human_part = parts[0].strip()
-        json_part = "{" + parts[1]
-    else:
-        human_part = raw_answer
-        json_part = "{}"
+    # Hand the query to the inference worker
+    response_q = asyncio.Queue(maxsize=1)
+    await app.model_queue.put((msg, response_q, False))
+    response = await response_q.get()
+    if isinstance(response, Exception):
+        print("❌ RAG pipeline error:", response)
+        return jsonify({"error": str(response)}), 500
 
-    try:
-        parsed_json = json.loads(json_part)
-        filters = parsed_json.get("filters", {})
-    except json.JSONDecodeError:
-        filters = {}
-
-    # ------------------- Prepare Final Output -------------------
-    final_output = {
-        "user_input": msg,
-        "answer": human_part,
-        "filters": filters,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-
-    # ------------------- Save to MongoDB -------------------
-    try:
-        result = chat_collection.insert_one(final_output)
-        final_output["_id"] = str(result.inserted_id)  # convert ObjectId for JSON serialization
-        print("💾 Chat saved to MongoDB")
-    except Exception as e:
-        print("⚠️ Failed to save chat:", e)
+    parsed = parse_answer(response.get("answer", ""))
+    final_output = build_final_output(msg, parsed, chat_writer)
+    query_cache.put(cache_key, parsed)
 
     print("✅ Response:", final_output)
     return jsonify(final_output)
 
 
+@app.route("/stream", methods=["POST"])
+async def chat_stream():
+    """Same as /get, but streams answer tokens over SSE and finishes with an `event: done` payload"""
+    form = await request.form
+    msg = form.get("msg")
+    if not msg:
+        return jsonify({"error": "No message provided"}), 400
+
+    print(f"🧠 User Input (stream): {msg}")
+
+    cache_key = normalize_query(msg)
+    cached = short_circuit(msg, cache_key, query_cache, chat_writer)
+
+    async def generate():
+        if cached is not None:
+            yield sse_event(cached, "done")
+            return
+
+        response_q = asyncio.Queue()
+        await app.model_queue.put((msg, response_q, True))
+
+        parts = []
+        while True:
+            chunk = await response_q.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                print("❌ RAG pipeline error:", chunk)
+                yield sse_event({"error": str(chunk)}, "error")
+                return
+            parts.append(chunk)
+            yield sse_event({"delta": chunk})
+
+        parsed = parse_answer("".join(parts))
+        final_output = build_final_output(msg, parsed, chat_writer)
+        query_cache.put(cache_key, parsed)
+
+        print("✅ Response:", final_output)
+        yield sse_event(final_output, "done")
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @app.route("/history", methods=["GET"])
 def history():
     """Retrieve last 10 chat entries"""
     try:
-        chats = list(chat_collection.find({}, {"_id": 0}).sort("timestamp", -1).limit(10))
+        projection = {"_id": 0, "user_input": 1, "answer": 1, "filters": 1, "timestamp": 1}
+        chats = list(chat_collection.find({}, projection).sort("timestamp", DESCENDING).limit(10))
+        for chat in chats:
+            if isinstance(chat.get("timestamp"), datetime):
+                chat["timestamp"] = chat["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
         return jsonify(chats)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-# ------------------- Run Flask App -------------------
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Return response cache hit/miss counters"""
+    return jsonify(query_cache.stats())
+
+
+# ------------------- Run Quart App -------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py / Procfile)
+    app.run(host="0.0.0.0", port=8080, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,5 @@
+from src.helper import export_int8_minilm, ONNX_MODEL_DIR
+
+# One-time step for CPU deployments: export MiniLM to INT8 ONNX so test2.py / test3.py
+# can load it with load_query_embedder(). Run before starting the servers.
+export_int8_minilm(ONNX_MODEL_DIR)
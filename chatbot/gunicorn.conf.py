@@ -0,0 +1,14 @@
+import os
+
+# Production server settings.
+# app.py, test2.py and test3.py are ASGI (Quart), so the default worker is Uvicorn's
+# (uvloop is used when installed):
+#   gunicorn -c gunicorn.conf.py app:app
+# sampleapp.py is WSGI (Flask); run it with the threaded worker instead:
+#   gunicorn -c gunicorn.conf.py -k gthread sampleapp:app
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+threads = 8  # only used by -k gthread
+keepalive = 30
+timeout = 120
@@ -1,14 +1,18 @@
-from flask import Flask, render_template, jsonify, request
-from src.helper import download_hugging_face_embeddings
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+from src.helper import download_hugging_face_embeddings, QueryCache, normalize_query, MongoBulkWriter, stable_sort_documents, \
+    short_circuit, parse_answer, build_final_output, sse_event
 from langchain_pinecone import PineconeVectorStore
 from langchain_community.llms import Ollama
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
-from pymongo import MongoClient
+from pymongo import MongoClient, DESCENDING
+from pymongo.write_concern import WriteConcern
 from dotenv import load_dotenv
 from src.prompt import *
 import os
+import atexit
 import json
 from datetime import datetime
 
@@ -23,10 +27,22 @@ MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
 
 # ------------------- MongoDB Setup -------------------
+chat_writer = None
 try:
-    mongo_client = MongoClient(MONGO_URI)
+    mongo_client = MongoClient(MONGO_URI, maxPoolSize=50, minPoolSize=5, serverSelectionTimeoutMS=2000)
     db = mongo_client["chatbot_dbbbb"]
     chat_collection = db["chat_history"]
+    # Chat saves are non-critical: fire-and-forget (w=0) handle for writes, acknowledged one for reads
+    chat_collection_fast = db.get_collection("chat_history", write_concern=WriteConcern(w=0))
+    chat_writer = MongoBulkWriter(chat_collection_fast, batch_size=100, flush_interval=1.0)
+    atexit.register(chat_writer.flush)
+except Exception as e:
+    print("❌ MongoDB setup error:", e)
+
+# MongoClient connects lazily, so this is the first real round-trip. If Mongo is down at boot
+# the writer above still exists and resumes saving once the server is reachable.
+try:
+    chat_collection.create_index([("timestamp", DESCENDING)], background=True)
     print("✅ Connected to MongoDB successfully!")
 except Exception as e:
     print("❌ MongoDB connection error:", e)
@@ -50,24 +66,40 @@ llm = Ollama(model="phi3:mini", temperature=0.3)
 # ------------------- Prompt Template -------------------
 
 
-prompt = ChatPromptTemplate.from_template(f"""
-{system_prompt}
+# system_prompt is bound once as a partial variable instead of being inlined into an f-string
+prompt = PromptTemplate.from_template("""
+{system}
 
 ---
 
 Context:
-{{context}}
+{context}
 
 User Query:
-{{input}}
+{input}
 
 Follow the exact JSON structure shown above.
-""")
+""").partial(system=system_prompt)
 
 
 # ------------------- Retrieval Chain -------------------
 question_answer_chain = create_stuff_documents_chain(llm, prompt)
-rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+# Retrieved docs are put in a stable order so identical contexts hit the LLM's prefix cache
+sorted_retriever = RunnableLambda(lambda x: x["input"]) | retriever | RunnableLambda(stable_sort_documents)
+rag_chain = create_retrieval_chain(sorted_retriever, question_answer_chain)
+
+# ------------------- Warm-up -------------------
+# Pay model load / TLS handshake / lazy-init costs before the first real request
+if os.getenv("WARMUP", "1") == "1":
+    try:
+        rag_chain.invoke({"input": "warmup"})
+        print("🔥 RAG chain warmed up")
+    except Exception as e:
+        print("⚠️ Warm-up failed:", e)
+
+# ------------------- Response Cache -------------------
+query_cache = QueryCache(max_size=2000, ttl=600)
+
 
 # ------------------- Routes -------------------
 @app.route("/")
@@ -83,55 +115,82 @@ def chat():
 
     print(f"🧠 User Input: {msg}")
 
+    # Trivial messages and repeated queries skip the pipeline
+    cache_key = normalize_query(msg)
+    cached = short_circuit(msg, cache_key, query_cache, chat_writer)
+    if cached is not None:
+        return jsonify(cached)
+
     # Run retrieval + generation
     response = rag_chain.invoke({"input": msg})
-    raw_answer = response.get("answer", "")
-
-    # ------------------- Parse JSON Output -------------------
-    if "{" in raw_answer:
-        parts = raw_answer.split("{", 1)
-        human_part = parts[0].strip()
-        json_part = "{" + parts[1]
-    else:
-        human_part = raw_answer
-        json_part = "{}"
-
-    try:
-        parsed_json = json.loads(json_part)
-        filters = parsed_json.get("filters", {})
-    except json.JSONDecodeError:
-        filters = {}
-
-    # ------------------- Final Output -------------------
-    final_output = {
-        "user_input": msg,
-        "answer": human_part,
-        "filters": filters,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-
-    # ------------------- Save to MongoDB -------------------
-    try:
-        result = chat_collection.insert_one(final_output)
-        final_output["_id"] = str(result.inserted_id)
-        print("💾 Chat saved to MongoDB")
-    except Exception as e:
-        print("⚠️ Failed to save chat:", e)
+    parsed = parse_answer(response.get("answer", ""))
+    final_output = build_final_output(msg, parsed, chat_writer)
+    query_cache.put(cache_key, parsed)
 
     print("✅ Response:", final_output)
     return jsonify(final_output)
 
 
+@app.route("/stream", methods=["POST"])
+def chat_stream():
+    """Same as /get, but streams answer tokens over SSE and finishes with an `event: done` payload"""
+    msg = request.form.get("msg")
+    if not msg:
+        return jsonify({"error": "No message provided"}), 400
+
+    print(f"🧠 User Input (stream): {msg}")
+
+    cache_key = normalize_query(msg)
+    cached = short_circuit(msg, cache_key, query_cache, chat_writer)
+
+    def generate():
+        if cached is not None:
+            yield sse_event(cached, "done")
+            return
+
+        parts = []
+        try:
+            for chunk in rag_chain.stream({"input": msg}):
+                if chunk.get("answer"):
+                    parts.append(chunk["answer"])
+                    yield sse_event({"delta": chunk["answer"]})
+        except Exception as e:
+            print("❌ RAG pipeline error:", e)
+            yield sse_event({"error": str(e)}, "error")
+            return
+
+        parsed = parse_answer("".join(parts))
+        final_output = build_final_output(msg, parsed, chat_writer)
+        query_cache.put(cache_key, parsed)
+
+        print("✅ Response:", final_output)
+        yield sse_event(final_output, "done")
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
 @app.route("/history", methods=["GET"])
 def history():
     """Retrieve last 10 chat entries"""
     try:
-        chats = list(chat_collection.find({}, {"_id": 0}).sort("timestamp", -1).limit(10))
+        projection = {"_id": 0, "user_input": 1, "answer": 1, "filters": 1, "timestamp": 1}
+        chats = list(chat_collection.find({}, projection).sort("timestamp", DESCENDING).limit(10))
+        for chat in chats:
+            if isinstance(chat.get("timestamp"), datetime):
+                chat["timestamp"] = chat["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
         return jsonify(chats)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Return response cache hit/miss counters"""
+    return jsonify(query_cache.stats())
+
+
 # ------------------- Run Flask App -------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py / Procfile)
+    app.run(host="0.0.0.0", port=8080, debug=os.getenv("FLASK_DEBUG") == "1")
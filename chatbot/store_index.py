@@ -1,6 +1,6 @@
-from src.helper import load_json_files, text_split, download_hugging_face_embeddings
+from src.helper import load_documents_cached, text_split, download_hugging_face_embeddings, document_id
 from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone import ServerlessSpec
+from pinecone import ServerlessSpec, PodSpec
 from langchain_pinecone import PineconeVectorStore
 from dotenv import load_dotenv
 import os
@@ -12,29 +12,43 @@ load_dotenv()
 PINECONE_API_KEY=os.environ.get('PINECONE_API_KEY')
 os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
 
-extracted_data = load_json_files(data_folder='Data/')
+extracted_data = load_documents_cached(data_folder='Data/')
 text_chunks = text_split(extracted_data)
 embeddings = download_hugging_face_embeddings()
 
 
 pc = Pinecone(api_key=PINECONE_API_KEY)
 
-index_name = "companydata"
-
-
-pc.create_index(
-    name=index_name,
-    dimension=384, 
-    metric="cosine", 
-    spec=ServerlessSpec(
+index_name = os.getenv("PINECONE_INDEX_NAME", "infyndcompanydata")
+
+# Vectors are L2-normalized at encode time (see download_hugging_face_embeddings).
+# Set PINECONE_POD_TYPE (e.g. "s1.x1") to use a storage-optimized pod, which keeps
+# vectors in a compressed representation; otherwise a serverless index is created.
+pod_type = os.getenv("PINECONE_POD_TYPE")
+if pod_type:
+    spec = PodSpec(
+        environment=os.getenv("PINECONE_ENVIRONMENT", "us-east-1-aws"),
+        pod_type=pod_type
+    )
+else:
+    spec = ServerlessSpec(
         cloud="aws", 
         region="us-east-1"
-    ) 
-) 
+    )
+
+if index_name not in pc.list_indexes().names():
+    pc.create_index(
+        name=index_name,
+        dimension=384, 
+        metric="cosine", 
+        spec=spec
+    )
 
 # Embed each chunk and upsert the embeddings into your Pinecone index.
+# Stable ids make re-runs overwrite existing vectors instead of adding duplicates.
 docsearch = PineconeVectorStore.from_documents(
     documents=text_chunks,
     index_name=index_name,
     embedding=embeddings, 
+    ids=[document_id(doc) for doc in text_chunks],
 )
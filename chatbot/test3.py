@@ -1,15 +1,15 @@
-from flask import Flask, render_template, jsonify, request
+from quart import Quart, render_template, jsonify, request
 from dotenv import load_dotenv
 from pinecone import Pinecone
-from sentence_transformers import SentenceTransformer
+from src.helper import load_query_embedder, embed_query, source_filter, group_by_source
 from langchain_community.llms import Ollama
-from collections import defaultdict
 from json_repair import repair_json
 import os
 import json
+import asyncio
 
 load_dotenv()
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Initialize Pinecone
 pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
@@ -17,9 +17,17 @@ index_name = os.getenv("PINECONE_INDEX_NAME", "infyndcompanydata")
 index = pc.Index(index_name)
 
 # Embedding model & LLM
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+embedder = load_query_embedder()
 llm = Ollama(model="phi3:mini")
 
+# Warm-up: load model weights / torch lazy inits and open the Pinecone connection up front
+if os.getenv("WARMUP", "1") == "1":
+    try:
+        index.query(vector=embedder.encode("warmup").tolist(), top_k=1)
+        print("🔥 Embedder and Pinecone warmed up")
+    except Exception as e:
+        print(f"⚠️ Warm-up failed: {e}")
+
 # ---------------------------
 # Utility: JSON repair + validation
 # ---------------------------
@@ -35,13 +43,14 @@ def validate_and_repair_json(llm_output: str):
             raise ValueError(f"Failed to repair/parse JSON: {e}")
 
 @app.route("/")
-def home():
-    return render_template("chat.html")
+async def home():
+    return await render_template("chat.html")
 
 
 @app.route("/get", methods=["POST"])
-def chat():
-    query = request.form.get("msg", "").strip()
+async def chat():
+    form = await request.form
+    query = form.get("msg", "").strip()
     if not query:
         return jsonify({
             "summary": "Please enter a query.",
@@ -53,8 +62,18 @@ def chat():
 
     # ---- Step 1: Query Pinecone ----
     try:
-        query_vector = embedder.encode(query).tolist()
-        result = index.query(vector=query_vector, top_k=20, include_metadata=True)
+        # Blocking embed + Pinecone calls run off the event loop (encode must precede query)
+        query_vector = await asyncio.to_thread(embed_query, embedder, query)
+        metadata_filter = source_filter(query)
+        # One round trip: metadata (short text) without the 384-float vector values
+        result = await asyncio.to_thread(
+            index.query, vector=query_vector, top_k=20, include_metadata=True, include_values=False,
+            filter=metadata_filter
+        )
+        if metadata_filter and not result.matches:
+            result = await asyncio.to_thread(
+                index.query, vector=query_vector, top_k=20, include_metadata=True, include_values=False
+            )
     except Exception as e:
         print(f"❌ Pinecone error: {e}")
         return jsonify({
@@ -64,18 +83,7 @@ def chat():
         })
 
     # ---- Step 2: Group results by source ----
-    grouped = defaultdict(list)
-    for match in result.matches:
-        meta = match.metadata or {}
-        source = meta.get("source", "unknown_source")
-        text = meta.get("text", "")
-        if text:
-            try:
-                grouped[source].append(json.loads(text))
-            except:
-                grouped[source].append({"text": text})
-
-    structured_output = dict(grouped)
+    structured_output = group_by_source(m.metadata for m in result.matches)
     print(f"🔹 Structured output before validation: {structured_output}")
 
     # ---- Step 3: Build Prompt for LLM ----
@@ -112,12 +120,12 @@ The output must be a valid JSON (no extra text or code fences) in this format:
 User Query: "{query}"
 
 Structured JSON:
-{json.dumps(structured_output, indent=2)}
+{json.dumps(structured_output, separators=(",", ":"))}
 """
 
     # ---- Step 4: Get & Parse LLM Output ----
     try:
-        llm_output = llm.invoke(prompt).strip()
+        llm_output = (await asyncio.to_thread(llm.invoke, prompt)).strip()
         print("\n🔹 Raw LLM output:", llm_output)
 
         # Remove unwanted code fences or markdown
@@ -145,6 +153,7 @@ Structured JSON:
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py / Procfile)
+    app.run(host="0.0.0.0", port=8080, debug=os.getenv("FLASK_DEBUG") == "1")
 
 